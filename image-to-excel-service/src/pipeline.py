@@ -0,0 +1,831 @@
+"""
+Shared image -> structured data pipeline: image preparation, Bedrock inference,
+JSON recovery and schema validation. Handlers call process_image() with a schema,
+or process_images() to share Bedrock requests across a batch of uploads.
+"""
+import io
+import re
+import time
+import hashlib
+import threading
+import boto3
+import orjson
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Clients (module scope + keep-alive so warm invocations reuse TLS connections)
+client_config = Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    # Fail fast on a dead endpoint; bound a stalled response instead of letting it
+    # run into the function timeout (streamed replies reset this on every chunk)
+    connect_timeout=3,
+    read_timeout=60,
+    retries={'max_attempts': 3, 'mode': 'adaptive'}
+)
+s3_client = boto3.client('s3', config=client_config)
+bedrock_runtime = boto3.client('bedrock-runtime', region_name='us-east-1', config=client_config)
+
+DEFAULT_MODEL_ID = 'us.meta.llama4-maverick-17b-instruct-v1:0'
+
+# Longest edge sent to Bedrock (a multiple of the vision encoder's patch grid)
+EXTRACTOR_MAX_DIM = 896
+
+# Image formats accepted by Bedrock Converse (Pillow names)
+BEDROCK_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Model output parsing
+_CODE_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$', re.IGNORECASE)
+_ANGLE_RE = re.compile(r'(0|90|180|270)')
+# A whole JSON string literal (escapes included, possibly unterminated) or a single bracket
+_JSON_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"?|[\[\]{}]', re.DOTALL)
+
+EXTRACTION_ATTEMPTS = 2
+
+# Images packed into one extraction request; more would crowd the model's context with pixels
+BATCH_MAX_IMAGES = 4
+# Field the model echoes in each packed answer object, naming the "Image N" label it describes
+IMAGE_INDEX_FIELD = 'image_index'
+
+# Uploads this uniform (grayscale std dev) or this dark are not worth a Bedrock call
+BLANK_MAX_STDDEV = 5.0
+DARK_LEVEL = 32
+DARK_MAX_FRACTION = 0.98
+
+# A reported rotation below this confidence is ignored rather than paying for a second extraction
+ROTATION_MIN_CONFIDENCE = 60
+
+# Vendor-specific reading rules, rendered into the weigh ticket prompt once at import
+VENDOR_HINTS = {
+    "CEMEX": 'Job Location is usually "Ship-to Address", Product is under "Material". '
+             "If the year on the ticket date is cut off, partially printed, or reads like '202', you MUST assume the year is 2026 (e.g. 02/17/2026).",
+    "Vulcan Materials": 'Net Weight is often at the bottom right labeled "Net Lbs" (divide by 2000 to get Tons).',
+    "Blue Water Industries": "They often don't print the year. Assume the year is 2026. "
+                             'The Ticket Number is literally labeled "Ticket".',
+    "Florida Aggregate": 'Do NOT confuse "Hours" for "Tons". If the line next to "Tons:" is blank, return an empty string.',
+    "Titan America": 'The Product Name is explicitly labeled "Product:" halfway down the ticket (e.g., "#89 STONE"). Do NOT grab the location name under the top logo. For the Truck ID, use the number strictly next to "Vehicle:" regardless of its length. Do NOT use the long number next to "Hauler:".',
+}
+
+# Known vendors as lowercase word tuples, longest first, for canonicalizing the model's vendor_name
+VENDOR_TOKENS = sorted(((tuple(v.lower().split()), v) for v in VENDOR_HINTS), key=lambda t: -len(t[0]))
+
+def canonical_vendor(name: str) -> str:
+    """
+    Maps a detected vendor name onto the known spelling when its leading words match
+    (e.g. "Vulcan Materials Company" -> "Vulcan Materials"); other names are returned unchanged.
+    Whole-word matching, so "Vulcan" alone or inside unrelated text does not match.
+    """
+    words = tuple(name.lower().split())
+    for tokens, vendor in VENDOR_TOKENS:
+        if words[:len(tokens)] == tokens:
+            return vendor
+    return name
+
+SINGLE_IMAGE_TASK = "Analyze this weigh ticket image. You MUST return a JSON list containing ONE object."
+PACKED_IMAGES_TASK = (
+    'Analyze each weigh ticket image below; every image follows an "Image N" label. '
+    'You MUST return a JSON list containing ONE object per image, and every object MUST include '
+    f'"{IMAGE_INDEX_FIELD}": N (integer) naming the image it describes.'
+)
+
+WEIGH_TICKET_PROMPT_TEMPLATE = """
+{task}
+For EACH field, return an object with "value" (string) and "confidence" (0-100 integer).
+
+VENDOR ALIGNMENT HINTS (Use these rules if the vendor matches):
+{vendor_hints}
+
+Fields to extract:
+- ticket_number: (Unique ID on the ticket)
+- transaction_date: (Date in YYYY-MM-DD format. If the year is cut off or missing (e.g., '02/17/202'), assume 2026 BUT YOU MUST SET CONFIDENCE TO 40 so the user checks it.)
+- transaction_time: (Time, e.g., 12:56 PM)
+- vendor_name: (Source company name, e.g., CEMEX, Palm Beach Aggregates)
+- customer_name: (Who the product is for)
+- job_location: (Where it's going)
+- truck_id: (Vehicle ID)
+- product_name: (Material name)
+- net_weight_tons: (Amount in tons. If the space/line next to 'Tons' or 'Net' is completely blank, return "" and 0 confidence. Do NOT grab random unrelated numbers like Hours.)
+- rotation: (How the ticket is physically rotated in the image: "0" upright, "90" rotated clockwise, "180" upside down, "270" rotated counter-clockwise)
+
+Rules:
+1. Return ONLY raw JSON inside [].
+2. All "value" fields must be STRINGS wrapped in double quotes. 
+3. No thousands separators (no commas in numbers).
+4. If a field is not found, return "value": "" and "confidence": 0.
+5. CRITICAL: If you are GUESSING or INFERRING a value because it is cut off, blurry, or missing (like guessing a year from '02/17/202'), you MUST set the "confidence" to 40 or lower. Do not claim 99 confidence for a guess.
+6. CRITICAL: If any number or text is faded, semi-transparent, stamped over, or generally poorly visible but you can still make a best guess, you MUST set the "confidence" to 30 or lower so it gets flagged for review. Do not fallback to a clearer but incorrect number nearby.
+7. CRITICAL: DO NOT INCLUDE ANY CONVERSATIONAL TEXT, GREETINGS, OR MARKDOWN.
+
+Example Format:
+[
+    {{
+        "ticket_number": {{"value": "12345", "confidence": 99}},
+        "vendor_name": {{"value": "CEMEX", "confidence": 85}},
+        "net_weight_tons": {{"value": "24.50", "confidence": 95}}
+    }}
+]
+"""
+
+# --- 1. Schemas (what to extract and how to validate it) ---
+
+class ExtractionSchema(ABC):
+    """
+    Strategy describing one kind of document: the prompt sent with the image,
+    the fields expected back, and how to validate them.
+    """
+    name = None
+    version = None # Bump whenever the prompt changes so stale cached responses are ignored
+    prompt = None
+    packed_prompt = None # Variant for several labelled images in one request; None disables packing
+    system_prompt = None
+    fields = ()
+    rotation_field = None # Extra field where the model reports how the page is rotated, if the prompt asks
+
+    @abstractmethod
+    def validate(self, data: dict) -> dict:
+        pass
+
+    def detected_rotation(self, data: dict) -> int:
+        """
+        Counter-clockwise degrees needed to make the page upright, from the model's
+        rotation_field answer. 0 when upright, not reported or not confident enough.
+        """
+        entry = data.get(self.rotation_field) if self.rotation_field else None
+        if not isinstance(entry, dict):
+            return 0
+        angle_match = _ANGLE_RE.fullmatch(str(entry.get('value', '')).strip())
+        try:
+            confidence = int(float(entry.get('confidence', 0)))
+        except (TypeError, ValueError):
+            return 0
+        if angle_match is None or confidence < ROTATION_MIN_CONFIDENCE:
+            return 0
+        return int(angle_match.group(1))
+
+class WeighTicketSchema(ExtractionSchema):
+    name = "weigh_ticket"
+    version = "v4"
+    # Prompt with Confidence Scores & Strict Formatting
+    _vendor_hints = "\n".join(f'- If "{vendor}": {hint}' for vendor, hint in VENDOR_HINTS.items())
+    prompt = WEIGH_TICKET_PROMPT_TEMPLATE.format(task=SINGLE_IMAGE_TASK, vendor_hints=_vendor_hints)
+    packed_prompt = WEIGH_TICKET_PROMPT_TEMPLATE.format(task=PACKED_IMAGES_TASK, vendor_hints=_vendor_hints)
+    system_prompt = [{"text": "You are an automated data extraction system. You must output ONLY valid JSON. Do not write any conversational text before or after the JSON list."}]
+    # Fields requested from the model, in CSV column order
+    fields = (
+        'ticket_number', 'transaction_date', 'transaction_time', 'vendor_name', 'customer_name',
+        'job_location', 'truck_id', 'product_name', 'net_weight_tons'
+    )
+    rotation_field = 'rotation' # Asked for alongside the fields, never written to the outputs
+
+    def validate(self, data: dict) -> dict:
+        """
+        Checks the parsed model output against the ticket schema and normalizes it to
+        {field: {"value": str, "confidence": int}} for every field in self.fields.
+        Raises ValueError describing the first problem found.
+        """
+        # An empty or off-schema answer would otherwise pass as a ticket of blanks
+        if not any(field in data for field in self.fields):
+            raise ValueError(f"AI response has none of the ticket fields: {', '.join(self.fields)}")
+        ticket = {}
+        for field in self.fields:
+            entry = data.get(field)
+            if entry is None:
+                # Missing fields are treated like "not found" per the prompt rules
+                ticket[field] = {"value": "", "confidence": 0}
+                continue
+            if not isinstance(entry, dict):
+                entry = {"value": entry, "confidence": 0} # Fallback if AI returns a flat value
+            if 'value' not in entry:
+                raise ValueError(f'"{field}" must be an object with "value" and "confidence"')
+
+            value = entry['value']
+            value = "" if value is None else str(value).strip()
+            try:
+                confidence = int(float(entry.get('confidence', 0)))
+            except (TypeError, ValueError):
+                raise ValueError(f'"{field}.confidence" must be an integer from 0 to 100') from None
+
+            if field == 'transaction_date' and value:
+                try:
+                    datetime.strptime(value, '%Y-%m-%d')
+                except ValueError:
+                    raise ValueError(f'"transaction_date" must use YYYY-MM-DD format, got "{value}"') from None
+            elif field == 'vendor_name':
+                value = canonical_vendor(value) # Consistent archive names across spellings
+
+            ticket[field] = {"value": value, "confidence": max(0, min(100, confidence))}
+        return ticket
+
+WEIGH_TICKET_SCHEMA = WeighTicketSchema()
+
+# --- 2. Extraction Cache ---
+
+class ExtractionCache:
+    """
+    Content-addressable cache of raw Bedrock responses stored in S3.
+    Keyed on (model_id, prompt_version, sha256(image bytes)) so duplicate scans skip inference.
+    A small in-process LRU sits in front of S3, so repeats on a warm instance skip the GET too.
+    """
+    MEMORY_SIZE = 256
+    _memory = OrderedDict() # Shared by all instances: S3 key -> generated_text
+    _memory_lock = threading.Lock() # Batches are processed on threads
+
+    @classmethod
+    def _remember(cls, key, generated_text):
+        with cls._memory_lock:
+            cls._memory[key] = generated_text
+            cls._memory.move_to_end(key)
+            if len(cls._memory) > cls.MEMORY_SIZE:
+                cls._memory.popitem(last=False)
+
+    @classmethod
+    def _recall(cls, key):
+        with cls._memory_lock:
+            generated_text = cls._memory.get(key)
+            if generated_text is not None:
+                cls._memory.move_to_end(key)
+            return generated_text
+
+    def __init__(self, bucket_name, model_id, prompt_version):
+        self.bucket_name = bucket_name
+        self.model_id = model_id
+        self.prompt_version = prompt_version
+
+    def _key(self, image_bytes: bytes):
+        # Length prefix keeps the digest unambiguous across inputs of different sizes
+        digest = hashlib.sha256(len(image_bytes).to_bytes(8, 'big'))
+        digest.update(image_bytes)
+        return f"llm-cache/{self.model_id}/{self.prompt_version}/{digest.hexdigest()}.json"
+
+    def get(self, image_bytes: bytes):
+        key = self._key(image_bytes)
+        generated_text = self._recall(key)
+        if generated_text is not None:
+            return generated_text
+        try:
+            with s3_client.get_object(Bucket=self.bucket_name, Key=key)['Body'] as body:
+                generated_text = orjson.loads(body.read())['generated_text']
+            self._remember(key, generated_text)
+            return generated_text
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                print(f"Cache: Lookup failed: {e}")
+        except BotoCoreError as e: # Timeouts and connection errors: treat as a miss
+            print(f"Cache: Lookup failed: {e}")
+        except (ValueError, KeyError) as e:
+            print(f"Cache: Ignoring corrupt entry: {e}")
+        return None
+
+    def put(self, image_bytes: bytes, generated_text: str):
+        key = self._key(image_bytes)
+        self._remember(key, generated_text)
+        try:
+            s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=orjson.dumps({"generated_text": generated_text}),
+                ContentType='application/json'
+            )
+            print(f"Cache: Saved response to s3://{self.bucket_name}/{key}")
+        except (BotoCoreError, ClientError) as e:
+            print(f"Cache: Write failed: {e}")
+
+# --- 3. Model Output Parsing ---
+
+def extract_balanced(text: str, open_ch: str, close_ch: str):
+    """
+    Returns the first balanced open_ch...close_ch region of text, or None.
+    Single left-to-right pass that ignores brackets inside JSON string literals.
+    """
+    start = text.find(open_ch)
+    if start == -1:
+        return None
+
+    depth = 0
+    # Only visits string literals and brackets; the text between them is skipped in C
+    for match in _JSON_TOKEN_RE.finditer(text, start):
+        token = match.group()
+        if token == open_ch:
+            depth += 1
+        elif token == close_ch:
+            depth -= 1
+            if depth == 0:
+                return text[start:match.end()]
+    return None
+
+def parse_model_list(generated_text: str) -> list:
+    """
+    Extracts the JSON list from the raw model output; a lone object counts as a list of one.
+    Tries a direct parse first (the common case), then scans for the first balanced list or object.
+    Raises ValueError if no JSON can be found.
+    """
+    text = _CODE_FENCE_RE.sub('', generated_text.strip())
+    try:
+        parsed = orjson.loads(text)
+    except orjson.JSONDecodeError:
+        parsed = None
+        # Fallback to single object if list is missing or malformed
+        for open_ch, close_ch in (('[', ']'), ('{', '}')):
+            span = extract_balanced(text, open_ch, close_ch)
+            if span is None:
+                continue
+            try:
+                parsed = orjson.loads(span)
+                break
+            except orjson.JSONDecodeError:
+                continue
+        if parsed is None:
+            raise ValueError("No JSON found in AI response")
+
+    items = parsed if isinstance(parsed, list) else [parsed]
+    if not all(isinstance(item, dict) for item in items):
+        raise ValueError("AI response is not a JSON object")
+    return items
+
+def parse_model_json(generated_text: str) -> dict:
+    """
+    Extracts the first JSON object from the raw model output.
+    Raises ValueError if no JSON can be found.
+    """
+    items = parse_model_list(generated_text)
+    if not items:
+        raise ValueError("AI response is an empty JSON list")
+    return items[0]
+
+# --- 4. Image Preparation ---
+
+# Imaging libraries are imported on first use so their load time stays out of the cold start
+@lru_cache(maxsize=None)
+def load_pillow():
+    from PIL import Image, ImageOps
+    return Image, ImageOps
+
+@lru_cache(maxsize=None)
+def load_pyvips():
+    try:
+        import pyvips # Optional: only available when the libvips layer is attached
+        return pyvips
+    except (ImportError, OSError):
+        return None
+
+@lru_cache(maxsize=None)
+def webp_supported():
+    from PIL import features
+    return features.check('webp')
+
+def encode_for_bedrock(image):
+    """
+    Encodes a Pillow or pyvips image as WebP, or JPEG when no WebP encoder is available.
+    Returns (encoded_bytes, format).
+    """
+    pyvips = load_pyvips()
+    if pyvips is not None and isinstance(image, pyvips.Image):
+        try:
+            return image.write_to_buffer('.webp[Q=80]'), 'WEBP'
+        except pyvips.Error:
+            return image.write_to_buffer('.jpg[Q=85]'), 'JPEG'
+
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    img_byte_arr = io.BytesIO()
+    fmt = 'WEBP' if webp_supported() else 'JPEG'
+    if fmt == 'WEBP':
+        image.save(img_byte_arr, format=fmt, quality=80, method=4)
+    else:
+        image.save(img_byte_arr, format=fmt, quality=85)
+    # getvalue() hands over BytesIO's internal bytes object without copying (nothing else
+    # holds a view on it), so the same object backs every Converse request that uses it
+    return img_byte_arr.getvalue(), fmt
+
+def rotate_counter_clockwise(image, angle: int):
+    """
+    Rotates a Pillow or pyvips image by a multiple of 90 degrees, counter-clockwise.
+    """
+    pyvips = load_pyvips()
+    if pyvips is not None and isinstance(image, pyvips.Image):
+        # vips rotates clockwise
+        return image.rot(f"d{(360 - angle) % 360}")
+    return image.rotate(angle, expand=True)
+
+class UnreadableImageError(ValueError):
+    """
+    The upload has nothing to extract. Final for those bytes, so not worth a retry.
+    """
+
+def looks_blank(image) -> bool:
+    """
+    Cheap check for uploads with nothing to read: a near-uniform frame (blank page,
+    lens cap) or one that is almost entirely black. Works on a Pillow or pyvips image.
+    """
+    pyvips = load_pyvips()
+    if pyvips is not None and isinstance(image, pyvips.Image):
+        gray = image.colourspace('b-w')[0]
+        stddev = gray.deviate()
+        dark_fraction = (gray < DARK_LEVEL).avg() / 255
+    else:
+        from PIL import ImageStat
+        # One histogram pass gives both the spread and the share of dark pixels
+        histogram = image.convert('L').histogram()
+        stddev = ImageStat.Stat(histogram).stddev[0]
+        dark_fraction = sum(histogram[:DARK_LEVEL]) / sum(histogram)
+    return stddev < BLANK_MAX_STDDEV or dark_fraction > DARK_MAX_FRACTION
+
+def prepare_image(original_bytes: bytes, max_dim: int):
+    """
+    Auto-rotates (EXIF) and shrinks the upload to fit max_dim for Bedrock.
+    Only re-encodes when something changed; otherwise the upload bytes are reused.
+    Returns (image, encoded_bytes, format), where image is the decoded Pillow or pyvips image.
+    """
+    Image, ImageOps = load_pillow()
+    pyvips = load_pyvips()
+    if pyvips is not None:
+        # Shrink-on-load: libvips decodes JPEGs at a reduced DCT scale instead of full resolution
+        vimg = pyvips.Image.thumbnail_buffer(original_bytes, max_dim, height=max_dim, size='down')
+        if vimg.hasalpha():
+            vimg = vimg.flatten(background=255)
+        # Hand back the vips image itself so a later rotation works on the decoded
+        # pixels instead of decoding the lossy encode again. vips pipelines are
+        # sequential streams, so render the small result to memory to allow reuse.
+        vimg = vimg.copy_memory()
+        file_content, fmt = encode_for_bedrock(vimg)
+        return vimg, file_content, fmt
+
+    image = Image.open(io.BytesIO(original_bytes))
+    
+    # Already upright, small enough and in a Bedrock format: skip the decode/re-encode round-trip
+    if (image.format in BEDROCK_FORMATS and max(image.size) <= max_dim
+            and image.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1):
+        return image, original_bytes, image.format
+    
+    # Phone cameras often write MPO (JPEG with an embedded depth/preview frame); it decodes the same way
+    if image.format in ('JPEG', 'MPO'):
+        # Pillow's libjpeg-turbo decodes at 1/2, 1/4 or 1/8 scale straight from the DCT,
+        # so a 12MP phone photo never gets fully decoded just to be thrown away by thumbnail()
+        image.draft('RGB', (max_dim, max_dim))
+    
+    # Auto-rotate based on EXIF data (fixes sideways smartphone photos)
+    image = ImageOps.exif_transpose(image)
+    
+    if max(image.size) > max_dim:
+        # draft() already got within 2x of the target, so the sharper LANCZOS filter is cheap here
+        # and keeps small print legible for the model
+        image.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
+        
+    file_content, fmt = encode_for_bedrock(image)
+    return image, file_content, fmt
+
+# --- 5. Inference ---
+
+def image_block(file_content: bytes, fmt: str) -> dict:
+    """
+    Converse content block for an encoded image. References the bytes object as-is,
+    so the same upload can back several requests without being copied.
+    """
+    return {"image": {"format": fmt.lower(), "source": {"bytes": file_content}}}
+
+def converse_until_json(**request) -> str:
+    """
+    Streams a Bedrock Converse response and stops reading as soon as the first
+    complete JSON list has arrived, instead of waiting for the model to finish.
+    """
+    response = bedrock_runtime.converse_stream(**request)
+    stream = response['stream']
+    chunks = []
+    try:
+        for event in stream:
+            text = event.get('contentBlockDelta', {}).get('delta', {}).get('text')
+            if not text:
+                continue
+            chunks.append(text)
+            if ']' in text:
+                span = extract_balanced(''.join(chunks), '[', ']')
+                if span is not None:
+                    try:
+                        orjson.loads(span)
+                        break
+                    except orjson.JSONDecodeError:
+                        pass
+    finally:
+        if hasattr(stream, 'close'):
+            stream.close()
+    return ''.join(chunks)
+
+def extract_cached(file_content: bytes, schema: ExtractionSchema, cache=None):
+    """
+    Returns (validated data, rotation) from a cached response for these image bytes, or None.
+    """
+    if cache is None:
+        return None
+    cached_text = cache.get(file_content)
+    if cached_text is None:
+        return None
+    try:
+        parsed = parse_model_json(cached_text)
+        data = schema.validate(parsed)
+        print("Cache hit: Skipping Bedrock")
+        return data, schema.detected_rotation(parsed)
+    except ValueError as e:
+        print(f"Cache: Ignoring invalid entry: {e}")
+        return None
+
+def extract(file_content: bytes, fmt: str, schema: ExtractionSchema, model_id: str, cache=None):
+    """
+    Runs the schema's prompt against the image.
+    Returns (validated data, rotation the model reported for the page).
+    Short-circuits on a cached response for identical image bytes, and retries
+    once with the validation error as feedback.
+    """
+    cached = extract_cached(file_content, schema, cache)
+    if cached is not None:
+        return cached
+
+    messages = [{"role": "user", "content": [{"text": schema.prompt}, image_block(file_content, fmt)]}]
+
+    for attempt in range(EXTRACTION_ATTEMPTS):
+        print("Invoking Bedrock...")
+        generated_text = converse_until_json(
+            modelId=model_id,
+            messages=messages,
+            system=schema.system_prompt,
+            inferenceConfig={"maxTokens": 600, "temperature": 0.0} # 9 fields fit in ~400 tokens
+        )
+        print("Raw AI Response:", generated_text)
+        
+        try:
+            parsed = parse_model_json(generated_text)
+            data = schema.validate(parsed)
+        except ValueError as e:
+            if attempt == EXTRACTION_ATTEMPTS - 1:
+                raise
+            # Retry with feedback: show the model its answer and what was wrong with it
+            print(f"Validation failed (attempt {attempt + 1}): {e}")
+            messages = messages + [
+                {"role": "assistant", "content": [{"text": generated_text}]},
+                {"role": "user", "content": [{"text": f"Validation error: {e}. Return corrected JSON only."}]}
+            ]
+            time.sleep(1.0 * (attempt + 1))
+            continue
+
+        if cache is not None:
+            cache.put(file_content, generated_text)
+        return data, schema.detected_rotation(parsed)
+
+def packed_index(parsed: dict):
+    """
+    The 1-based image number a packed answer object claims to describe, or None.
+    """
+    index = parsed.get(IMAGE_INDEX_FIELD)
+    if isinstance(index, dict):
+        index = index.get('value')
+    try:
+        return int(str(index).strip())
+    except ValueError:
+        return None
+
+def extract_packed(images: list, schema: ExtractionSchema, model_id: str) -> list:
+    """
+    Extracts several images with one Bedrock request: each image goes in behind an
+    "Image N" label and the model echoes N in its object, which is how answers are matched
+    back. images is a list of (encoded_bytes, format). Returns a (validated data, rotation)
+    tuple per image, or None where the answer was missing, duplicated or invalid (extract
+    that one alone). Packed answers are never cached; only single-image answers are.
+    """
+    content = [{"text": schema.packed_prompt}]
+    for n, (file_content, fmt) in enumerate(images, 1):
+        content += [{"text": f"Image {n}:"}, image_block(file_content, fmt)]
+    print(f"Invoking Bedrock for {len(images)} packed images...")
+    generated_text = converse_until_json(
+        modelId=model_id,
+        messages=[{"role": "user", "content": content}],
+        system=schema.system_prompt,
+        inferenceConfig={"maxTokens": 600 * len(images), "temperature": 0.0}
+    )
+    print("Raw AI Response:", generated_text)
+
+    try:
+        items = parse_model_list(generated_text)
+    except ValueError as e:
+        print(f"Packed extraction unusable: {e}")
+        return [None] * len(images)
+
+    by_index = {}
+    duplicates = set()
+    for parsed in items:
+        index = packed_index(parsed)
+        if index in by_index:
+            duplicates.add(index)
+        by_index[index] = parsed
+
+    results = []
+    for n in range(1, len(images) + 1):
+        parsed = by_index.get(n)
+        if parsed is None or n in duplicates:
+            # Can't tell which ticket this answer belongs to, so don't guess
+            print(f"Packed extraction: No unambiguous answer for image {n}")
+            results.append(None)
+            continue
+        try:
+            data = schema.validate(parsed)
+        except ValueError as e:
+            print(f"Packed extraction: Invalid object for image {n}: {e}")
+            results.append(None)
+            continue
+        results.append((data, schema.detected_rotation(parsed)))
+    return results
+
+def extract_batch(images: list, schema: ExtractionSchema, model_id: str, cache=None) -> list:
+    """
+    Extracts a batch of images, packing up to BATCH_MAX_IMAGES uncached ones per Bedrock
+    request and falling back to one request per image for anything the packed call missed.
+    Cache lookups and requests run concurrently, so a batch costs about one round-trip.
+    images is a list of (encoded_bytes, format). Returns a (validated data, rotation)
+    tuple per image, or the exception that image failed with.
+    """
+    if not images:
+        return []
+
+    def extract_alone(i):
+        try:
+            return extract(images[i][0], images[i][1], schema, model_id, cache)
+        except Exception as e:
+            return e
+
+    def extract_group(group):
+        if len(group) < 2 or schema.packed_prompt is None:
+            # Without a packed prompt every image goes alone, in parallel
+            with ThreadPoolExecutor(max_workers=len(group)) as alone:
+                return list(alone.map(extract_alone, group))
+        try:
+            packed = extract_packed([images[i] for i in group], schema, model_id)
+        except Exception as e:
+            print(f"Packed extraction failed: {e}")
+            packed = [None] * len(group)
+        # Anything the packed call missed is extracted on its own, one request per image
+        missing = [i for i, result in zip(group, packed) if result is None]
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as fallback:
+                retried = dict(zip(missing, fallback.map(extract_alone, missing)))
+            packed = [retried.get(i, result) for i, result in zip(group, packed)]
+        return packed
+
+    with ThreadPoolExecutor(max_workers=len(images)) as executor:
+        results = list(executor.map(lambda image: extract_cached(image[0], schema, cache), images))
+        pending = [i for i, result in enumerate(results) if result is None]
+        groups = [pending[start:start + BATCH_MAX_IMAGES] for start in range(0, len(pending), BATCH_MAX_IMAGES)]
+        for group, group_results in zip(groups, executor.map(extract_group, groups)):
+            for i, result in zip(group, group_results):
+                results[i] = result
+    return results
+
+class ImagePreprocessor:
+    """
+    Dedicated vision-preprocessing step: resize, EXIF orientation fix, encode.
+    When given a bucket, the normalized bytes are stored under cache/.../{sha256 of upload}
+    (replaced by the upright version after a rotation) so redelivered or re-uploaded
+    images skip the decode, resize and rotation.
+    """
+    def __init__(self, model_id, prompt_version, bucket_name=None):
+        self.model_id = model_id
+        self.prompt_version = prompt_version
+        self.bucket_name = bucket_name
+        self.image = None # Decoded image from the last preprocess(), None after a cache hit
+        self.key = None
+        self.rotated = False # Bytes already carry the model's rotation fix
+
+    def _load(self, key):
+        try:
+            obj = s3_client.get_object(Bucket=self.bucket_name, Key=key)
+            with obj['Body'] as body:
+                # Check the format from the headers before pulling the image down
+                metadata = obj.get('Metadata', {})
+                fmt = metadata.get('format')
+                if fmt is None:
+                    print(f"Preprocess cache: Ignoring entry without format: {key}")
+                    return None
+                return body.read(), fmt, metadata.get('rotated') == 'true'
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                print(f"Preprocess cache: Lookup failed: {e}")
+        except BotoCoreError as e:
+            print(f"Preprocess cache: Lookup failed: {e}")
+        return None
+
+    def _store(self, key, file_content: bytes, fmt: str):
+        try:
+            s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=file_content,
+                ContentType=f"image/{fmt.lower()}",
+                Metadata={'format': fmt, 'rotated': 'true' if self.rotated else 'false'}
+            )
+        except (BotoCoreError, ClientError) as e:
+            print(f"Preprocess cache: Write failed: {e}")
+
+    def preprocess(self, original_bytes: bytes):
+        """
+        Returns (encoded_bytes, sha256 of the upload, format) ready for Bedrock.
+        """
+        sha = hashlib.sha256(original_bytes).hexdigest()
+        # The stored bytes embed the model's rotation answer, so key on the model and prompt too
+        self.key = key = f"cache/{self.model_id}/{self.prompt_version}/{sha}"
+        self.image = None
+        self.rotated = False
+        if self.bucket_name:
+            cached = self._load(key)
+            if cached is not None:
+                print("Preprocess cache hit: Skipping resize")
+                file_content, fmt, self.rotated = cached
+                return file_content, sha, fmt
+
+        self.image, file_content, fmt = prepare_image(original_bytes, EXTRACTOR_MAX_DIM)
+        # Fail before any Bedrock call; blank uploads never reach the cache either
+        if looks_blank(self.image):
+            raise UnreadableImageError("Image appears blank or too dark to read")
+        if self.bucket_name:
+            self._store(key, file_content, fmt)
+        return file_content, sha, fmt
+
+    def rotate(self, file_content: bytes, angle: int):
+        """
+        Rotates the preprocessed image counter-clockwise and re-encodes it.
+        Works on the decoded pixels when still held, otherwise decodes file_content.
+        The cached copy is marked as rotated, so the fix is only ever applied once.
+        Returns (encoded_bytes, format).
+        """
+        image = self.image
+        if image is None:
+            Image, _ = load_pillow()
+            image = Image.open(io.BytesIO(file_content))
+        self.image = rotate_counter_clockwise(image, angle)
+        self.rotated = True
+        file_content, fmt = encode_for_bedrock(self.image)
+        if self.bucket_name:
+            self._store(self.key, file_content, fmt)
+        return file_content, fmt
+
+def process_image(original_bytes: bytes, schema: ExtractionSchema, model_id: str = DEFAULT_MODEL_ID, cache=None) -> dict:
+    """
+    Full pipeline for one uploaded image: resize, extract and validate.
+    The model reports the page rotation alongside the fields, so upright tickets (the
+    common case) take a single Bedrock call; rotated ones are turned and extracted again.
+    When a cache is given, preprocessing results are cached alongside it in the same bucket.
+    """
+    preprocessor = ImagePreprocessor(model_id, schema.version, cache.bucket_name if cache is not None else None)
+    file_content, _, fmt = preprocessor.preprocess(original_bytes)
+    data, angle = extract(file_content, fmt, schema, model_id, cache)
+    # Turned bytes are extracted as-is: a second rotation answer is not acted on
+    if angle and not preprocessor.rotated:
+        print(f"Fixing AI detected rotation: {angle} degrees")
+        file_content, fmt = preprocessor.rotate(file_content, angle)
+        data, _ = extract(file_content, fmt, schema, model_id, cache)
+    return data
+
+def process_images(originals: list, schema: ExtractionSchema, model_id: str = DEFAULT_MODEL_ID, cache=None) -> list:
+    """
+    Batch version of process_image() for several uploads at once: images are resized in
+    parallel, then packed into shared Bedrock requests (see extract_batch).
+    Returns the validated data per upload, or the exception that upload failed with.
+    """
+    if not originals:
+        return []
+    bucket_name = cache.bucket_name if cache is not None else None
+    preprocessors = [ImagePreprocessor(model_id, schema.version, bucket_name) for _ in originals]
+
+    def preprocess(pair):
+        preprocessor, original_bytes = pair
+        try:
+            file_content, _, fmt = preprocessor.preprocess(original_bytes)
+            return file_content, fmt
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=len(originals)) as executor:
+        prepared = list(executor.map(preprocess, zip(preprocessors, originals)))
+        ready = [i for i, item in enumerate(prepared) if not isinstance(item, Exception)]
+        results = list(prepared)
+        for i, result in zip(ready, extract_batch([prepared[i] for i in ready], schema, model_id, cache)):
+            results[i] = result
+
+        def finish(i):
+            result = results[i]
+            if isinstance(result, Exception):
+                return result
+            data, angle = result
+            if not angle or preprocessors[i].rotated:
+                return data
+            # Rotated tickets are turned and extracted again on their own
+            try:
+                print(f"Fixing AI detected rotation: {angle} degrees")
+                file_content, fmt = preprocessors[i].rotate(prepared[i][0], angle)
+                return extract(file_content, fmt, schema, model_id, cache)[0]
+            except Exception as e:
+                return e
+
+        return list(executor.map(finish, range(len(originals))))
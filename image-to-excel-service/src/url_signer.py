@@ -1,12 +1,26 @@
-import json
+import io
+import csv
+import orjson
 import os
+import time
 import boto3
+from functools import lru_cache
 from botocore.config import Config
 from botocore.exceptions import ClientError
 
+# Module scope + keep-alive so warm invocations reuse the TLS connection for status reads and saves
 s3_client = boto3.client('s3', 
                          region_name='us-east-1', # Match template
-                         config=Config(signature_version='s3v4'))
+                         config=Config(signature_version='s3v4',
+                                       tcp_keepalive=True,
+                                       connect_timeout=3,
+                                       read_timeout=10,
+                                       retries={'max_attempts': 3, 'mode': 'adaptive'}))
+
+# Bucket names are fixed per deployment, so read them once per container
+INPUT_BUCKET = os.environ['INPUT_BUCKET']
+OUTPUT_BUCKET = os.environ['OUTPUT_BUCKET']
+ARCHIVE_BUCKET = os.environ['ARCHIVE_BUCKET']
 
 def lambda_handler(event, context):
     """
@@ -24,7 +38,7 @@ def lambda_handler(event, context):
         elif path == '/status':
             return handle_status_request(params)
         elif path == '/save':
-            body = json.loads(event.get('body', '{}'))
+            body = orjson.loads(event.get('body') or '{}')
             return handle_save_request(body)
         else:
             return response(404, {'error': 'Route not found'})
@@ -34,14 +48,13 @@ def lambda_handler(event, context):
         return response(500, {'error': 'Internal server error'})
 
 def handle_upload_request(params):
-    bucket_name = os.environ['INPUT_BUCKET']
     file_name = params.get('file')
     if not file_name:
         return response(400, {'error': 'Missing "file" parameter'})
 
     url = s3_client.generate_presigned_url(
         'put_object',
-        Params={'Bucket': bucket_name, 'Key': file_name},
+        Params={'Bucket': INPUT_BUCKET, 'Key': file_name},
         ExpiresIn=300
     )
     return response(200, {'upload_url': url})
@@ -54,23 +67,21 @@ def handle_status_request(params):
     if not file_name:
         return response(400, {'error': 'Missing "file" parameter'})
 
-    output_bucket = os.environ['OUTPUT_BUCKET']
-    archive_bucket = os.environ['ARCHIVE_BUCKET']
     status_key = f"status/{file_name}.json"
 
     try:
         # Check if status marker exists
-        response_obj = s3_client.get_object(Bucket=output_bucket, Key=status_key)
-        status_data = json.loads(response_obj['Body'].read().decode('utf-8'))
+        with s3_client.get_object(Bucket=OUTPUT_BUCKET, Key=status_key)['Body'] as body:
+            status_data = orjson.loads(body.read())
         
         if status_data.get('status') == 'error':
             return response(200, status_data) # Send the error status directly to frontend
         
         # Generate GET URLs
         urls = {
-            'csv': generate_get_url(output_bucket, status_data['csv_key']),
-            'image': generate_get_url(archive_bucket, status_data['image_key']),
-            'json': generate_get_url(archive_bucket, status_data['json_key'])
+            'csv': generate_get_url(OUTPUT_BUCKET, status_data['csv_key']),
+            'image': generate_get_url(ARCHIVE_BUCKET, status_data['image_key']),
+            'json': generate_get_url(ARCHIVE_BUCKET, status_data['json_key'])
         }
 
         return response(200, {
@@ -101,30 +112,31 @@ def handle_save_request(body):
     if not all([csv_key, json_key, data]):
         return response(400, {'error': 'Missing required fields: csv_key, json_key, data'})
 
-    output_bucket = os.environ['OUTPUT_BUCKET']
-    archive_bucket = os.environ['ARCHIVE_BUCKET']
 
     try:
         # 1. Save JSON
         s3_client.put_object(
-            Bucket=archive_bucket,
+            Bucket=ARCHIVE_BUCKET,
             Key=json_key,
-            Body=json.dumps(data, indent=2),
+            Body=orjson.dumps(data),
             ContentType='application/json'
         )
 
-        # 2. Regenerate CSV (Simple CSV gen to avoid heavy pandas in signer if possible)
-        # However, for consistency with processor, let's just do a clean join
-        import io
-        import csv
-        
-        output = io.StringIO()
-        writer = csv.DictWriter(output, fieldnames=data.keys())
+        # 2. Regenerate CSV the same way the processor writes it:
+        # one row of plain values (the review form sends {value, confidence} pairs), no thousands separators
+        row = {
+            k: str(v['value'] if isinstance(v, dict) and 'value' in v else v).replace(',', '')
+            for k, v in data.items()
+        }
+        output = io.BytesIO()
+        text_stream = io.TextIOWrapper(output, encoding='utf-8', newline='')
+        writer = csv.DictWriter(text_stream, fieldnames=list(row))
         writer.writeheader()
-        writer.writerow(data)
+        writer.writerow(row)
+        text_stream.detach() # Flushes and leaves output open
         
         s3_client.put_object(
-            Bucket=output_bucket,
+            Bucket=OUTPUT_BUCKET,
             Key=csv_key,
             Body=output.getvalue(),
             ContentType='text/csv'
@@ -137,6 +149,12 @@ def handle_save_request(body):
         return response(500, {'error': f'Failed to save: {str(e)}'})
 
 def generate_get_url(bucket, key):
+    # URLs live for an hour, so repeat status polls within the same minute reuse one
+    # instead of redoing the SigV4 signing (at least 59 minutes of validity remain)
+    return _signed_get_url(bucket, key, int(time.time()) // 60)
+
+@lru_cache(maxsize=1024)
+def _signed_get_url(bucket, key, minute):
     return s3_client.generate_presigned_url(
         'get_object',
         Params={'Bucket': bucket, 'Key': key},
@@ -150,5 +168,5 @@ def response(status, body):
             'Content-Type': 'application/json',
             'Access-Control-Allow-Origin': '*'
         },
-        'body': json.dumps(body)
+        'body': orjson.dumps(body).decode()
     }